@@ -5,7 +5,6 @@ Usage:
    python3 digestify.py [-c] [-a algorithm] [-o origin] [filename [...]]
 """
 import argparse
-import binascii
 import sys
 
 import dns.rdata
@@ -66,7 +65,7 @@ def main():
             if not args.placeholder:
                 zone_rr = zonemd.update_zonemd(zone,
                                                zonemd_algorithm=args.algorithm)
-            digest_hex = binascii.b2a_hex(zone_rr.digest).decode()
+            digest_hex = zone_rr.digest.hex()
             zonemd_filename = filename + ".zonemd"
             with open(zonemd_filename, "w") as output_fp:
                 zone.to_file(output_fp, relativize=False)
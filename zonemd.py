@@ -19,8 +19,9 @@ functions to support a two-step process:
    and updates the placeholder ZONEMD record. The resulting ZONEMD
    record can be signed if desired.
 """
-import binascii
 import hashlib
+import hmac
+import operator
 import struct
 
 import dns.rdata
@@ -39,6 +40,19 @@ ZONEMD_DIGEST_SHA512 = 2
 # Flag to output ZONEMD as an unknown type.
 ZONEMD_AS_GENERIC = False
 
+# Pre-compiled structures for the fixed-size wire formats, so that we
+# do not parse the format strings for every RR.
+_PACK_IBB = struct.Struct('!IBB').pack
+_UNPACK_IBB_FROM = struct.Struct('!IBB').unpack_from
+_PACK_HHI = struct.Struct('!HHI').pack
+_PACK_H = struct.Struct('!H').pack
+
+# Sort key for (name, node) pairs, so that only the names are compared.
+_NODE_NAME_KEY = operator.itemgetter(0)
+
+# Size at which the buffered canonical RRs are handed to the hash.
+_DIGEST_CHUNK_SIZE = 65536
+
 
 class ZONEMD(dns.rdata.Rdata):
     """
@@ -72,8 +86,8 @@ class ZONEMD(dns.rdata.Rdata):
         """
         Convert to a format suitable for digesting in hashes.
         """
-        return struct.pack('!IBB', self.serial,
-                           self.scheme, self.algorithm) + self.digest
+        return (_PACK_IBB(self.serial, self.scheme, self.algorithm) +
+                self.digest)
 
     def to_text(self, origin=None, relativize=True, **kw):
         """
@@ -82,10 +96,9 @@ class ZONEMD(dns.rdata.Rdata):
         """
         if ZONEMD_AS_GENERIC:
             rdata = self.to_digestable()
-            text = (r"\# " + str(len(rdata)) + " " +
-                    binascii.b2a_hex(rdata).decode())
+            text = r"\# " + str(len(rdata)) + " " + rdata.hex()
         else:
-            digest_hex = binascii.b2a_hex(self.digest).decode()
+            digest_hex = self.digest.hex()
             text = (str(self.serial) + ' ' +
                     str(self.scheme) + ' ' +
                     str(self.algorithm) + ' ' + digest_hex)
@@ -99,7 +112,8 @@ class ZONEMD(dns.rdata.Rdata):
         algorithm = tok.get_uint8()
         # Not sure why calling tok.concatenate_remaining_identifiers() here
         # causes an exception.  The loop below is copied from dns/tokenizer.py
-        tdigest = ""
+        # but collects the pieces in a list rather than growing a string.
+        parts = []
         while True:
             token = tok.get().unescape()
             if token.is_eol_or_eof():
@@ -107,8 +121,8 @@ class ZONEMD(dns.rdata.Rdata):
                 break
             if not token.is_identifier():
                 raise dns.exception.SyntaxError
-            tdigest += token.value
-        digest = binascii.a2b_hex(tdigest)
+            parts.append(token.value)
+        digest = bytes.fromhex(''.join(parts))
         return cls(rdclass, serial, scheme, algorithm, digest)
 
     def to_wire(self, file, compress=None, origin=None):
@@ -117,8 +131,10 @@ class ZONEMD(dns.rdata.Rdata):
     # pylint: disable=too-many-arguments
     @classmethod
     def from_wire(cls, rdclass, rdtype, wire, current, rdlen, origin=None):
-        serial, scheme, algorithm = struct.unpack('!IBB', wire[:6])
-        digest = wire[6:]
+        if rdlen < 6:
+            raise dns.exception.FormError
+        serial, scheme, algorithm = _UNPACK_IBB_FROM(wire, current)
+        digest = bytes(wire[current + 6:current + rdlen])
         return cls(rdclass, serial, scheme, algorithm, digest)
 
 
@@ -136,6 +152,65 @@ _EMPTY_DIGEST_BY_ALGORITHM = {
     ZONEMD_DIGEST_SHA512: b'\0' * 64
 }
 
+# Utility dictionaries with the hash constructor for each algorithm. These
+# default to hashlib, which uses OpenSSL (and so any SHA instructions the
+# CPU has), and can be replaced via set_hash_factory().
+_DEFAULT_HASH_FACTORY_BY_ALGORITHM = {
+    ZONEMD_DIGEST_SHA384: hashlib.sha384,
+    ZONEMD_DIGEST_SHA512: hashlib.sha512
+}
+_HASH_FACTORY_BY_ALGORITHM = dict(_DEFAULT_HASH_FACTORY_BY_ALGORITHM)
+
+
+def _algorithm_number(zonemd_algorithm):
+    """
+    Get the number of a digest algorithm, given either its name or its
+    number.
+
+    @raises ZoneDigestUnknownAlgorithm: zonemd_algorithm is unknown
+    """
+    if zonemd_algorithm in ('sha384', ZONEMD_DIGEST_SHA384):
+        return ZONEMD_DIGEST_SHA384
+    if zonemd_algorithm in ('sha512', ZONEMD_DIGEST_SHA512):
+        return ZONEMD_DIGEST_SHA512
+    msg = 'Unknown or unsupported algorithm ' + str(zonemd_algorithm)
+    raise ZoneDigestUnknownAlgorithm(msg)
+
+
+def set_hash_factory(zonemd_algorithm, factory):
+    """
+    Set the function used to create hash objects for a digest algorithm.
+
+    This allows a different SHA implementation to be used in place of
+    hashlib. The factory is called with no arguments and must return an
+    object with hashlib-style update() and digest() methods.
+
+    @var zonemd_algorithm: The name of the algorithm, either "sha384",
+                           or the number of the algorithm.
+    @type zonemd_algorithm: str
+    @var factory: The hash constructor, or None to use hashlib.
+    @type factory: callable
+    @raises ZoneDigestUnknownAlgorithm: zonemd_algorithm is unknown
+    """
+    algorithm = _algorithm_number(zonemd_algorithm)
+    if factory is None:
+        factory = _DEFAULT_HASH_FACTORY_BY_ALGORITHM[algorithm]
+    _HASH_FACTORY_BY_ALGORITHM[algorithm] = factory
+
+
+def _zone_apex(zone):
+    """
+    Get the name of the zone apex.
+
+    This is zone.origin when the zone has a node there. Zones loaded
+    with an origin that does not match the file (for example by
+    digestify.py, which defaults to ".") fall back to the smallest name
+    in the zone.
+    """
+    if zone.origin in zone.nodes:
+        return zone.origin
+    return min(zone.keys())
+
 
 def add_zonemd(zone, zonemd_algorithm='sha384', zonemd_ttl=None):
     """
@@ -161,18 +236,11 @@ def add_zonemd(zone, zonemd_algorithm='sha384', zonemd_ttl=None):
 
     Returns the placeholder ZONEMD record added, as a ZONEMD object.
     """
-    if zonemd_algorithm in ('sha384', ZONEMD_DIGEST_SHA384):
-        algorithm = 1
-    elif zonemd_algorithm in ('sha512', ZONEMD_DIGEST_SHA512):
-        algorithm = 2
-    else:
-        msg = 'Unknown digest ' + zonemd_algorithm
-        raise ZoneDigestUnknownAlgorithm(msg)
-
+    algorithm = _algorithm_number(zonemd_algorithm)
     empty_digest = _EMPTY_DIGEST_BY_ALGORITHM[algorithm]
 
     # Get the zone name.
-    zone_name = min(zone.keys())
+    zone_name = _zone_apex(zone)
 
     # Remove any existing ZONEMD from the apex.
     zone.delete_rdataset(zone_name, ZONEMD_RTYPE)
@@ -204,41 +272,70 @@ def rdataset_sorter(rdataset):
     return (rdataset.rdtype, wire_rdata)
 
 
-def calculate_zonemd(zone, zonemd_algorithm='sha384'):
+def _wire_rdataset_sorter(wire_rdataset):
     """
-    Calculate the digest of the zone.
+    Like rdataset_sorter(), but takes a tuple of the RRSET and the wire
+    format of its RDATA, so that the RDATA is not converted again just
+    to sort.
+    """
+    rdataset, wire_rdatas = wire_rdataset
+    return (rdataset.rdtype, wire_rdatas[0])
+
+
+def _sorted_nodes(zone):
+    """
+    Get the (name, node) pairs of the zone in canonical order.
+    """
+    return sorted(zone.nodes.items(), key=_NODE_NAME_KEY)
 
-    Returns the digest for the zone.
+
+def _digest_zone(zone, hashing, sorted_nodes, override=None):
+    """
+    Update the hashing object with the canonical form of every RR in
+    the zone, other than the apex ZONEMD and its signatures.
+
+    An RRSET can be digested as if it had different RDATA, without
+    changing the zone, by passing a tuple of the RRSET and the wire
+    format of the RDATA to use for it (in the same order as the RRSET's
+    own RDATA) as the override.
 
     @var zone: The zone object to digest.
     @type zone: dns.zone.Zone
-    @var zonemd_algorithm: The name of the algorithm to use, either "sha384",
-                          or the number of the algorithm to use.
-    @type zonemd_algorithm: str
-    @raises ZoneDigestUnknownAlgorithm: zonemd_algorithm is unknown
-    @rtype: bytes
+    @var hashing: The hash object to update, as made by the factory
+                  registered for the algorithm (hashlib by default, see
+                  set_hash_factory()).
+    @var sorted_nodes: The (name, node) pairs of the zone in canonical
+                       order.
+    @type sorted_nodes: list
+    @var override: The RRSET to replace and its replacement wire RDATA,
+                   or None.
+    @type override: (dns.rdataset.Rdataset, list) tuple
     """
-    if zonemd_algorithm in ('sha384', ZONEMD_DIGEST_SHA384):
-        hashing = hashlib.sha384()
-    elif zonemd_algorithm in ('sha512', ZONEMD_DIGEST_SHA512):
-        hashing = hashlib.sha512()
+    # pylint: disable=too-many-locals,too-many-branches
+    if override is None:
+        override_rdataset, override_wire_rdatas = None, None
     else:
-        msg = 'Unknown or unsupported algorithm ' + str(zonemd_algorithm)
-        raise ZoneDigestUnknownAlgorithm(msg)
+        override_rdataset, override_wire_rdatas = override
 
-    # Sort the names in the zone. This is needed for canonization.
-    sorted_names = sorted(zone.keys())
+    # The canonical RRs are collected here and passed to the hash in
+    # large chunks, rather than making a call into the hash per RR.
+    wire_buffer = bytearray()
+
+    # Look up the apex node once, so that each node can be checked by
+    # identity rather than comparing every name with the origin.
+    apex_node = zone.nodes.get(zone.origin)
 
     # Iterate across each name in canonical order.
-    for name in sorted_names:
-        # Save the wire format of the name for later use.
-        wire_name = name.canonicalize().to_wire()
-
-        # Iterate across each RRSET in canonical order.
-        sorted_rdatasets = sorted(zone.find_node(name).rdatasets,
-                                  key=rdataset_sorter)
-        for rdataset in sorted_rdatasets:
-            if name == zone.origin:
+    for name, node in sorted_nodes:
+        # Save the canonical wire format of the name for later use.
+        wire_name = name.to_digestable()
+        is_apex = node is apex_node
+
+        # Extract the wire format of the RDATA of each RRSET. This is
+        # used both to sort the RRSETs and to digest the RRs.
+        wire_rdatasets = []
+        for rdataset in node.rdatasets:
+            if is_apex:
                 # Skip apex ZONEMD.
                 if rdataset.rdtype == ZONEMD_RTYPE:
                     continue
@@ -246,23 +343,66 @@ def calculate_zonemd(zone, zonemd_algorithm='sha384'):
                 if rdataset.rdtype == dns.rdatatype.RRSIG:
                     if rdataset.covers == ZONEMD_RTYPE:
                         continue
-
+            if rdataset is override_rdataset:
+                wire_rdatas = list(override_wire_rdatas)
+            else:
+                wire_rdatas = [rdata.to_digestable() for rdata in rdataset]
+            wire_rdatasets.append((rdataset, wire_rdatas))
+
+        # Iterate across each RRSET in canonical order. Most names only
+        # have a single RRSET, so skip sorting for those.
+        if len(wire_rdatasets) > 1:
+            wire_rdatasets.sort(key=_wire_rdataset_sorter)
+        for rdataset, wire_rdatas in wire_rdatasets:
             # Save the wire format of the type, class, and TTL for later use.
-            wire_set = struct.pack('!HHI', rdataset.rdtype, rdataset.rdclass,
-                                   rdataset.ttl)
-            # Extract the wire format of the RDATA and sort them.
-            wire_rdatas = []
-            for rdata in rdataset:
-                wire_rdatas.append(rdata.to_digestable())
+            wire_set = _PACK_HHI(rdataset.rdtype, rdataset.rdclass,
+                                 rdataset.ttl)
+            # Sort the wire format of the RDATA.
             wire_rdatas.sort()
 
-            # Finally update the digest for each RR.
-            for wire_rr in wire_rdatas:
-                hashing.update(wire_name)
-                hashing.update(wire_set)
-                hashing.update(struct.pack('!H', len(wire_rr)))
-                hashing.update(wire_rr)
+            # Finally add every RR in the RRSET to the buffer, updating
+            # the digest whenever enough data has been collected.
+            wire_owner = wire_name + wire_set
+            wire_buffer += b''.join([wire_owner + _PACK_H(len(wire_rr)) +
+                                     wire_rr for wire_rr in wire_rdatas])
+            if len(wire_buffer) >= _DIGEST_CHUNK_SIZE:
+                hashing.update(wire_buffer)
+                del wire_buffer[:]
+
+    hashing.update(wire_buffer)
+
+
+def calculate_zonemd(zone, zonemd_algorithm='sha384', sorted_nodes=None,
+                     override=None):
+    """
+    Calculate the digest of the zone.
+
+    Returns the digest for the zone.
 
+    @var zone: The zone object to digest.
+    @type zone: dns.zone.Zone
+    @var zonemd_algorithm: The name of the algorithm to use, either "sha384",
+                          or the number of the algorithm to use.
+    @type zonemd_algorithm: str
+    @var sorted_nodes: The (name, node) pairs of the zone in canonical
+                       order, or None to sort them here.
+    @type sorted_nodes: list
+    @var override: An RRSET to digest as if it had different RDATA, as a
+                   tuple of the RRSET and the wire format of the RDATA
+                   to use (in the same order as the RRSET's own RDATA),
+                   or None.
+    @type override: (dns.rdataset.Rdataset, list) tuple
+    @raises ZoneDigestUnknownAlgorithm: zonemd_algorithm is unknown
+    @rtype: bytes
+    """
+    algorithm = _algorithm_number(zonemd_algorithm)
+    hashing = _HASH_FACTORY_BY_ALGORITHM[algorithm]()
+
+    # Sort the names in the zone. This is needed for canonization.
+    if sorted_nodes is None:
+        sorted_nodes = _sorted_nodes(zone)
+
+    _digest_zone(zone, hashing, sorted_nodes, override)
     return hashing.digest()
 
 
@@ -286,8 +426,9 @@ def update_zonemd(zone, zonemd_algorithm='sha384'):
 
     Returns the ZONEMD record added, as a ZONEMD object.
     """
-    zone_name = min(zone.keys())
-    digest = calculate_zonemd(zone, zonemd_algorithm)
+    sorted_nodes = _sorted_nodes(zone)
+    zone_name = sorted_nodes[0][0]
+    digest = calculate_zonemd(zone, zonemd_algorithm, sorted_nodes)
     zonemd = zone.find_rdataset(zone_name, ZONEMD_RTYPE).items[0]
     zonemd.digest = digest
     return zonemd
@@ -306,8 +447,12 @@ def validate_zonemd(zone):
     message is "" if there is no error, otherwise a description of the
     problem.
     """
+    # pylint: disable=too-many-return-statements
+    # Sort the names once, as we may calculate the digest several times.
+    sorted_nodes = _sorted_nodes(zone)
+
     # Get the SOA and ZONEMD records for the zone.
-    zone_name = min(zone.keys())
+    zone_name = sorted_nodes[0][0]
     try:
         soa_rdataset = zone.get_rdataset(zone_name, dns.rdatatype.SOA)
         soa = soa_rdataset.items[0]
@@ -318,9 +463,14 @@ def validate_zonemd(zone):
     except KeyError:
         return False, "No ZONEMD digest record found"
 
+    # The ZONEMD RDATA are digested with placeholder digests. Rather
+    # than changing the records in the zone, we keep the wire format
+    # to digest them as here and pass it in as an override.
+    wire_zonemds = [zonemd.to_digestable() for zonemd in rdatasets.items]
+
     digests = {}
     original_digests = {}
-    for zonemd in rdatasets.items:
+    for index, zonemd in enumerate(rdatasets.items):
         # Verify that the SOA matches between the SOA and the ZONEMD.
         if soa.serial != zonemd.serial:
             err = ("SOA serial " + str(soa.serial) + " does not " +
@@ -339,26 +489,26 @@ def validate_zonemd(zone):
         original_digests[zonemd.algorithm] = zonemd.digest
 
         # Put a placeholder in for the ZONEMD.
-        if zonemd.algorithm in _EMPTY_DIGEST_BY_ALGORITHM:
-            zonemd.digest = _EMPTY_DIGEST_BY_ALGORITHM[zonemd.algorithm]
-        else:
-            zonemd.digest = b'\0' * len(zonemd.digest)
+        empty_digest = _EMPTY_DIGEST_BY_ALGORITHM.get(
+            zonemd.algorithm, b'\0' * len(zonemd.digest))
+        wire_zonemds[index] = ZONEMD(zonemd.rdclass, zonemd.serial,
+                                     zonemd.scheme, zonemd.algorithm,
+                                     empty_digest).to_digestable()
 
         # Calculate the digest.
-        digests[zonemd.algorithm] = calculate_zonemd(zone, zonemd.algorithm)
-
-    # Restore ZONEMD.
-    for zonemd in zone.find_rdataset(zone_name, ZONEMD_RTYPE).items:
-        zonemd.digest = original_digests[zonemd.algorithm]
-
-    # Verify the digest in the zone matches the calculated value.
-    if digests[zonemd.algorithm] != original_digests[zonemd.algorithm]:
-        zonemd_b2a = binascii.b2a_hex(original_digests[zonemd.algorithm])
-        zonemd_hex = zonemd_b2a.decode()
-        digest_hex = binascii.b2a_hex(digests[zonemd.algorithm]).decode()
-        err = ("ZONEMD digest " + zonemd_hex + " does not " +
-               "match calculated digest " + digest_hex)
-        return False, err
+        digests[zonemd.algorithm] = calculate_zonemd(
+            zone, zonemd.algorithm, sorted_nodes, (rdatasets, wire_zonemds))
+
+    # We need at least one ZONEMD that we know how to check.
+    if not original_digests:
+        return False, "No ZONEMD digest record with a supported scheme found"
+
+    # Verify every digest in the zone matches the calculated value.
+    for algorithm, original_digest in original_digests.items():
+        if not hmac.compare_digest(digests[algorithm], original_digest):
+            err = ("ZONEMD digest " + original_digest.hex() + " does not " +
+                   "match calculated digest " + digests[algorithm].hex())
+            return False, err
 
     # Everything matches, enjoy your zone.
     return True, ""